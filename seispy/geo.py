@@ -144,20 +144,9 @@ def snr(x, y):
 
 def latlon_from(lat1, lon1, azimuth, gcarc_dist):
     lat2 = asind((sind(lat1) * cosd(gcarc_dist)) + (cosd(lat1) * sind(gcarc_dist) * cosd(azimuth)))
-    if isinstance(gcarc_dist, np.ndarray):
-        lon2 = np.zeros_like(lat2)
-        for n in range(len(gcarc_dist)):
-            if cosd(gcarc_dist[n]) >= (cosd(90 - lat1) * cosd(90 - lat2[n])):
-                lon2[n] = lon1 + asind(sind(gcarc_dist[n]) * sind(azimuth) / cosd(lat2[n]))
-            else:
-                lon2[n] = lon1 + asind(sind(gcarc_dist[n]) * sind(azimuth) / cosd(lat2[n])) + 180
-    elif isinstance(azimuth, np.ndarray):
-        lon2 = np.zeros_like(lat2)
-        for n in range(len(azimuth)):
-            if cosd(gcarc_dist) >= (cosd(90 - lat1) * cosd(90 - lat2[n])):
-                lon2[n] = lon1 + asind(sind(gcarc_dist) * sind(azimuth[n]) / cosd(lat2[n]))
-            else:
-                lon2[n] = lon1 + asind(sind(gcarc_dist) * sind(azimuth[n]) / cosd(lat2[n])) + 180
+    if isinstance(gcarc_dist, np.ndarray) or isinstance(azimuth, np.ndarray):
+        lon2 = lon1 + asind(sind(gcarc_dist) * sind(azimuth) / cosd(lat2))
+        lon2 = np.where(cosd(gcarc_dist) >= (cosd(90 - lat1) * cosd(90 - lat2)), lon2, lon2 + 180)
     else:
         if (cosd(gcarc_dist) >= (cosd(90 - lat1) * cosd(90 - lat2))):
             lon2 = lon1 + asind(sind(gcarc_dist) * sind(azimuth) / cosd(lat2))
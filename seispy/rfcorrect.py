@@ -1,22 +1,46 @@
-from multiprocessing.sharedctypes import Value
 from obspy.io.sac.sactrace import SACTrace
 import numpy as np
-from scipy.interpolate import interp1d, interpn
-from scipy.signal import resample
+from scipy.interpolate import interp1d, RegularGridInterpolator
+from scipy.signal import resample, resample_poly
+from scipy.fft import next_fast_len
 from os.path import dirname, join, exists, basename, isfile, abspath
 from seispy.geo import skm2srad, sdeg2skm, rad2deg, latlon_from, \
                        asind, tand, srad2skm, km2deg
 from seispy.psrayp import get_psrayp
-from seispy.rfani import RFAni
-from seispy.slantstack import SlantStack
-from seispy.harmonics import Harmonics
-from seispy.utils import DepModel, Mod3DPerturbation
+from seispy.utils import DepModel, Mod3DPerturbation, njit, prange, HAS_NUMBA, FASTMATH, _ray_integrals, \
+                         _ray_integrals_cupy, check_backend
 import warnings
 import glob
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from fractions import Fraction
+
+
+def _meta_field(name):
+    """Property of RFStation accessing field ``name`` of the event list stored in ``_meta``"""
+    def fget(self):
+        return self._meta[name]
+
+    def fset(self, value):
+        self._meta[name] = value
+    return property(fget, fset, doc='``{}`` of each event in the event list'.format(name))
 
 
 class RFStation(object):
-    def __init__(self, data_path, only_r=False, prime_comp='R'):
+    event = _meta_field('event')
+    phase = _meta_field('phase')
+    evla = _meta_field('evla')
+    evlo = _meta_field('evlo')
+    evdp = _meta_field('evdp')
+    dis = _meta_field('dis')
+    bazi = _meta_field('bazi')
+    rayp = _meta_field('rayp')
+    mag = _meta_field('mag')
+    f0 = _meta_field('f0')
+
+    def __init__(self, data_path, only_r=False, prime_comp='R', n_workers=None, mmap=False):
         """
         Class for derivative process of RFs.
 
@@ -26,6 +50,11 @@ class RFStation(object):
         :type only_r: bool, optional
         :param prime_comp: Prime component in RF filename. ``R`` or ``Q`` for PRF and ``L`` or ``Z`` for SRF
         :type prime_comp: str
+        :param n_workers: Number of threads for reading SAC files, defaults to ``min(8, os.cpu_count() or 1)``
+        :type n_workers: int, optional
+        :param mmap: Whether read waveforms through a memory map of SAC files instead of parsing them with ObsPy,
+                     which is faster for stations with a large number of RFs, defaults to False
+        :type mmap: bool, optional
 
         .. warning::
 
@@ -35,6 +64,7 @@ class RFStation(object):
         self.only_r = only_r
         self.comp = prime_comp
         self._chech_comp()
+        self._data_key = 'data' + self.comp.lower()
         if isfile(data_path):
             data_path = dirname(abspath(data_path))
         self.staname = basename(abspath(data_path))
@@ -47,30 +77,41 @@ class RFStation(object):
             evt_lst = evt_lsts[0]
         self.dtype = {'names': ('event', 'phase', 'evla', 'evlo', 'evdp', 'dis', 'bazi', 'rayp', 'mag', 'f0'),
                  'formats': ('U20', 'U20', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4')}
-        self.event, self.phase, self.evla, self.evlo, self.evdp, self.dis, self.bazi, self.rayp, self.mag, self.f0 = \
-            np.loadtxt(evt_lst, dtype=self.dtype, unpack=True, ndmin=1)
+        self._meta = np.loadtxt(evt_lst, dtype=self.dtype, ndmin=1)
         self.rayp = skm2srad(self.rayp)
         self.ev_num = self.evla.shape[0]
         self.read_sample(data_path)
-        self.__dict__['data{}'.format(self.comp.lower())] = np.empty([self.ev_num, self.rflength])
+        # RFs are kept in float32 as stored in SAC files, ray geometry and travel times are float64
+        self.data = np.empty([self.ev_num, self.rflength], dtype=np.float32)
         if not only_r:
-            self.datat = np.empty([self.ev_num, self.rflength])
-            for _i, evt, ph in zip(range(self.ev_num), self.event, self.phase):
-                sac = SACTrace.read(join(data_path, evt + '_' + ph + '_{}.sac'.format(self.comp)))
-                sact = SACTrace.read(join(data_path, evt + '_' + ph + '_T.sac'))
-                self.__dict__['data{}'.format(self.comp.lower())][_i] = sac.data
-                self.datat[_i] = sact.data
+            self.datat = np.empty([self.ev_num, self.rflength], dtype=np.float32)
+        if n_workers is None:
+            n_workers = _default_workers()
+        if mmap:
+            read_data = _read_sac_data
         else:
-            for _i, evt, ph in zip(range(self.ev_num), self.event, self.phase):
-                sac = SACTrace.read(join(data_path, evt + '_' + ph + '_{}.sac'.format(self.comp)))
-                self.__dict__['data{}'.format(self.comp.lower())][_i] = sac.data
+            read_data = lambda fname: SACTrace.read(fname).data
+
+        def _read_one(evt_ph):
+            evt, ph = evt_ph
+            data = read_data(join(data_path, evt + '_' + ph + '_{}.sac'.format(self.comp)))
+            if only_r:
+                return data, None
+            return data, read_data(join(data_path, evt + '_' + ph + '_T.sac'))
+
+        # Reading SAC files is I/O bound, so threads overlap the file access
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for _i, (data, datat) in enumerate(pool.map(_read_one, zip(self.event, self.phase))):
+                self.data[_i] = data
+                if not only_r:
+                    self.datat[_i] = datat
 
     def read_sample(self, data_path):
         fname = glob.glob(join(data_path, self.event[0] + '_' + self.phase[0] + '_{}.sac'.format(self.comp)))
         if len(fname) == 0:
             raise FileNotFoundError('No such files with comp of {} in {}'.format(self.comp, data_path))
         else:
-            sample_sac = SACTrace.read(fname[0])
+            sample_sac = SACTrace.read(fname[0], headonly=True)
         self.stla = sample_sac.stla
         self.stlo = sample_sac.stlo
         if sample_sac.stel is None:
@@ -93,6 +134,22 @@ class RFStation(object):
         else:
             self._stel = value/1000
 
+    @property
+    def data(self):
+        """RFs in the prime component, i.e., ``datar``, ``dataq``, ``dataz`` or ``datal``
+        with shape of (:attr:`ev_num`, :attr:`rflength`)
+        """
+        return self.__dict__[self._data_key]
+
+    @data.setter
+    def data(self, value):
+        self.__dict__[self._data_key] = value
+
+    @property
+    def rf_data(self):
+        """:attr:`data` as a C-contiguous float32 array, copied only when the layout or dtype differs"""
+        return np.ascontiguousarray(self.data, dtype=np.float32)
+
     def _chech_comp(self):
         if self.comp in ['R', 'Q']:
             self.prime_phase = 'P'
@@ -111,18 +168,17 @@ class RFStation(object):
         if not isinstance(method, str):
             raise TypeError('\'type\' must be string, but {} type got'.format(type(method)))
         if method == 'single':
-            maxamp = np.nanmax(np.abs(self.__dict__['data{}'.format(self.comp.lower())]), axis=1)
+            maxamp = np.nanmax(np.abs(self.data), axis=1, keepdims=True)
         elif method == 'average':
-            amp = np.nanmax(np.abs(np.mean(self.__dict__['data{}'.format(self.comp.lower())], axis=0)))
-            maxamp = np.ones(self.ev_num) * amp
+            maxamp = np.nanmax(np.abs(np.mean(self.data, axis=0)), keepdims=True)
         else:
             raise ValueError('\'method\' must be in \'single\' and \'average\'')
-        for i in range(self.ev_num):
-            self.__dict__['data{}'.format(self.comp.lower())][i] /= maxamp[i]
-            if not self.only_r:
-                self.datat[i] /= maxamp[i]
+        # RFs of all zeros are left untouched instead of being filled with NaN
+        np.divide(self.data, maxamp, out=self.data, where=maxamp > 0)
+        if not self.only_r:
+            np.divide(self.datat, maxamp, out=self.datat, where=maxamp > 0)
 
-    def resample(self, dt):
+    def resample(self, dt, method='poly'):
         """Resample RFs with specified dt
 
 
@@ -130,12 +186,40 @@ class RFStation(object):
         ----------
         dt : float
             Target sampling interval in sec
+        method : str, optional
+            ``'poly'`` for polyphase filtering with :func:`scipy.signal.resample_poly`,
+            ``'fft'`` for Fourier method with :func:`scipy.signal.resample` and
+            ``'lanczos'`` for Lanczos interpolation with :func:`obspy.signal.interpolation.lanczos_interpolation`,
+            by default 'poly'
         """
-        npts = int(self.rflength * (self.sampling / dt)) + 1
-        self.__dict__['data{}'.format(self.comp.lower())] = resample(
-            self.__dict__['data{}'.format(self.comp.lower())], npts, axis=1)
+        if method == 'poly':
+            ratio = Fraction(float(self.sampling)).limit_denominator(1000) / Fraction(dt).limit_denominator(1000)
+            up, down = ratio.numerator, ratio.denominator
+
+            def _resample(data):
+                return resample_poly(data, up, down, axis=1, window=('kaiser', 5.0)).astype(data.dtype)
+            npts = int(np.ceil(self.rflength * up / down))
+        elif method == 'fft':
+            npts = int(self.rflength * (self.sampling / dt)) + 1
+            # zero-pad to a FFT-friendly length, so that prime lengths do not slow down the FFT
+            fast_len = next_fast_len(int(np.ceil(npts * dt / self.sampling)))
+            fast_npts = int(round(fast_len * self.sampling / dt))
+            pad_width = ((0, 0), (0, fast_len - self.rflength))
+
+            def _resample(data):
+                return resample(np.pad(data, pad_width), fast_npts, axis=1)[:, :npts]
+        elif method == 'lanczos':
+            from obspy.signal.interpolation import lanczos_interpolation
+            npts = int((self.rflength - 1) * (self.sampling / dt)) + 1
+
+            def _resample(data):
+                return np.array([lanczos_interpolation(np.require(tr, float, 'C'), -self.shift, self.sampling,
+                                                       -self.shift, dt, npts, a=20) for tr in data], dtype=data.dtype)
+        else:
+            raise ValueError('method must be in \'poly\', \'fft\' or \'lanczos\'')
+        self.data = _resample(self.data)
         if not self.only_r:
-            self.datat = resample(self.datat, npts, axis=1)
+            self.datat = _resample(self.datat)
         self.sampling = dt
         self.rflength = npts
         self.time_axis = np.arange(npts) * dt - self.shift
@@ -147,10 +231,9 @@ class RFStation(object):
         :param key: key to sort, defaults to ``bazi``
         :type key: str, optional
         """
-        idx = np.argsort(self.__dict__[key])
-        for keyarg in self.dtype['names']:
-            self.__dict__[keyarg] = self.__dict__[keyarg][idx]
-        self.__dict__['data{}'.format(self.comp.lower())] = self.__dict__['data{}'.format(self.comp.lower())][idx]
+        idx = np.argsort(self._meta[key])
+        self._meta = self._meta[idx]
+        self.data = self.data[idx]
         if not self.only_r:
             self.datat = self.datat[idx]
 
@@ -191,7 +274,7 @@ class RFStation(object):
             pass
         rf_corr, _ = moveoutcorrect_ref(self, skm2srad(ref_rayp), dep_range, chan=chan, velmod=velmod)
         if replace:
-            self.__dict__['data{}'.format(chan)] = rf_corr
+            self.data = rf_corr
             if not self.only_r:
                 self.datat = t_corr
         else:
@@ -235,21 +318,22 @@ class RFStation(object):
         pplat_s, pplon_s, _ , _, _, _, tps = psrf_1D_raytracing(self, dep_range, **kwargs)
         return pplat_s, pplon_s, tps
 
-    def psrf_3D_raytracing(self, mod3dpath, dep_range=np.arange(0, 150), srayp=None):
+    def psrf_3D_raytracing(self, mod3dpath, dep_range=np.arange(0, 150), srayp=None, backend='numpy'):
         self.dep_range = dep_range
         mod3d = Mod3DPerturbation(mod3dpath, dep_range)
-        pplat_s, pplon_s, _, _, tps = psrf_3D_raytracing(self, dep_range, mod3d, srayp=srayp)
+        pplat_s, pplon_s, _, _, tps = psrf_3D_raytracing(self, dep_range, mod3d, srayp=srayp, backend=backend)
         return pplat_s, pplon_s, tps
 
     def psrf_3D_moveoutcorrect(self, mod3dpath, **kwargs):
         warnings.warn('The fuction will be change to RFStation.psrf_3D_timecorrect in the future')
         self.psrf_3D_timecorrect(mod3dpath, **kwargs)
 
-    def psrf_3D_timecorrect(self,  mod3dpath, dep_range=np.arange(0, 150), normalize='single', **kwargs):
+    def psrf_3D_timecorrect(self,  mod3dpath, dep_range=np.arange(0, 150), normalize='single', backend='numpy', **kwargs):
         self.dep_range = dep_range
         mod3d = Mod3DPerturbation(mod3dpath, dep_range)
-        pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps = psrf_1D_raytracing(self, dep_range, **kwargs)
-        tps = psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps, dep_range, mod3d)
+        geom = _psrf_1D_raytracing(self, dep_range, backend=backend, **kwargs)
+        tps = _psrf_3D_migration(geom.points_s, geom.points_p, geom.raylength_s, geom.raylength_p, geom.tps, mod3d,
+                                 backend=backend, out=geom.tps)
         rfdepth, _ = time2depth(self, dep_range, tps, normalize=normalize)
         return rfdepth
 
@@ -276,13 +360,15 @@ class RFStation(object):
         :return: Dominant fast velocity direction and time delay
         :rtype: list, list
         """
+        from seispy.rfani import RFAni
         self.ani = RFAni(self, tb, te, tlen=tlen, rayp=rayp, model=velmodel)
         self.ani.baz_stack(val=stack_baz_val)
         best_f, best_t = self.ani.joint_ani(weight=weight)
         return best_f, best_t
 
     def slantstack(self, ref_dis=None, rayp_range=None, tau_range=None):
-        self.slant = SlantStack(self.__dict__['data{}'.format(self.comp.lower())], self.time_axis, self.dis)
+        from seispy.slantstack import SlantStack
+        self.slant = SlantStack(self.data, self.time_axis, self.dis)
         self.slant.stack(ref_dis, rayp_range, tau_range)
         return self.slant.stack_amp
 
@@ -304,6 +390,7 @@ class RFStation(object):
         """
         if self.only_r:
             raise ValueError('Transverse RFs are nessary for harmonic decomposition')
+        from seispy.harmonics import Harmonics
         self.harmo = Harmonics(self, tb, te)
         self.harmo.harmo_trans()
         return self.harmo.harmonic_trans, self.harmo.unmodel_trans
@@ -321,13 +408,107 @@ class SACStation(RFStation):
         super().__init__(data_path, only_r=only_r)
 
 
+class RayGeom(object):
+    def __init__(self, ev_num, dep_range):
+        """Ray geometry of S and P waves of all events at discrete depths.
+        Depths, latitudes and longitudes of conversion points are held in one buffer
+        with shape of (2, ``ev_num``, ``dep_range.size``, 3) for S and P waves, so that
+        the 2D fields and the points for querying 3D models are views without copy.
+
+        :param ev_num: Number of events
+        :type ev_num: int
+        :param dep_range: 1D array of depths in km
+        :type dep_range: numpy.ndarray
+        """
+        ndep = dep_range.shape[0]
+        self.points = np.zeros([2, ev_num, ndep, 3])
+        self.points[..., 0] = dep_range
+        self.raylength = np.zeros([2, ev_num, ndep])
+        self.tps = np.zeros([ev_num, ndep])
+
+    @property
+    def pplat_s(self):
+        return self.points[0, :, :, 1]
+
+    @property
+    def pplon_s(self):
+        return self.points[0, :, :, 2]
+
+    @property
+    def pplat_p(self):
+        return self.points[1, :, :, 1]
+
+    @property
+    def pplon_p(self):
+        return self.points[1, :, :, 2]
+
+    @property
+    def raylength_s(self):
+        return self.raylength[0]
+
+    @property
+    def raylength_p(self):
+        return self.raylength[1]
+
+    @property
+    def points_s(self):
+        """(dep, lat, lon) of S-wave conversion points with shape of (``ev_num*ndep``, 3)"""
+        return self.points[0].reshape(-1, 3)
+
+    @property
+    def points_p(self):
+        """(dep, lat, lon) of P-wave conversion points with shape of (``ev_num*ndep``, 3)"""
+        return self.points[1].reshape(-1, 3)
+
+
+def _default_workers():
+    """Default number of threads, ``os.cpu_count()`` may be None when the CPU count cannot be determined"""
+    return min(8, os.cpu_count() or 1)
+
+
+def _read_sac_data(fname):
+    """Read waveform of a SAC file through a memory map.
+    The header has a fixed size of 632 bytes (70 floats, 40 ints, 24 strings) followed by ``npts`` float32 samples.
+    The byte order is determined by the header version ``nvhdr``.
+    """
+    hdr_int = np.fromfile(fname, dtype='<i4', count=40, offset=70*4)
+    byteorder = '<'
+    if not 0 < hdr_int[6] < 20:
+        hdr_int = hdr_int.byteswap()
+        byteorder = '>'
+    return np.memmap(fname, dtype=byteorder+'f4', mode='r', offset=632, shape=(hdr_int[9],))
+
+
 def _imag2nan(arr):
-    StopIndex = np.where(np.imag(arr) == 1)[0]
-    if StopIndex.size != 0:
-        arr[StopIndex[0]:] = np.nan
+    # Mask values from the first imaginary one onward along the last axis
+    is_imag = np.imag(arr) == 1
+    if is_imag.any():
+        arr[np.logical_or.accumulate(is_imag, axis=-1)] = np.nan
     return arr
 
 
+@lru_cache(maxsize=32)
+def _get_depmod(velmod, ya_bytes, ya_shape, ya_dtype, stel):
+    """Build a :class:`seispy.utils.DepModel` once per velocity model, depth axis and elevation.
+    The returned instance is shared between calls and must not be modified.
+    """
+    YAxisRange = np.frombuffer(ya_bytes, dtype=ya_dtype).reshape(ya_shape)
+    return DepModel(YAxisRange, velmod, stel)
+
+
+def _cached_depmod(YAxisRange, velmod, stel):
+    """Cached :class:`seispy.utils.DepModel` of ``YAxisRange``, see :func:`_get_depmod`"""
+    return _get_depmod(velmod, YAxisRange.tobytes(), YAxisRange.shape, str(YAxisRange.dtype), stel)
+
+
+@lru_cache(maxsize=32)
+def _tpds_ref(dep_mod, raypref, sphere, phase):
+    """Read-only Ps time difference of the reference ray parameter, see :func:`moveoutcorrect_ref`"""
+    tpds, _, _ = xps_tps_map(dep_mod, raypref, raypref, sphere=sphere, phase=phase)
+    tpds.setflags(write=False)
+    return tpds
+
+
 def moveoutcorrect_ref(stadatar, raypref, YAxisRange, 
                        chan='r', velmod='iasp91', sphere=True, phase=1):
     """Moveout correction refer to a specified ray-parameter
@@ -352,43 +533,48 @@ def moveoutcorrect_ref(stadatar, raypref, YAxisRange,
         data = stadatar.datal
     else:
         raise ValueError('Field \'datar\' or \'datal\' must be in the SACStation')
-    dep_mod = DepModel(YAxisRange, velmod, stadatar.stel)
-    # x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    # x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    for i in range(stadatar.ev_num):
-        tps[i], _, _ = xps_tps_map(dep_mod, stadatar.rayp[i], stadatar.rayp[i], sphere=sphere, phase=phase)
-    Tpds_ref, _, _ = xps_tps_map(dep_mod, raypref, raypref, sphere=sphere, phase=phase)
-    Newdatar = np.zeros([stadatar.ev_num, stadatar.rflength])
+    dep_mod = _cached_depmod(YAxisRange, velmod, stadatar.stel)
+    rayp = stadatar.rayp[:, np.newaxis]
+    tps, _, _ = xps_tps_map(dep_mod, rayp, rayp, sphere=sphere, phase=phase)
+    Tpds_ref = _tpds_ref(dep_mod, raypref, sphere, phase)
+    Newdatar = np.zeros([stadatar.ev_num, stadatar.rflength], dtype=data.dtype)
     EndIndex = np.zeros(stadatar.ev_num)
-#
+    head_axis = np.append(np.arange(-shift, 0, sampling), 0)
+    Refaxis = np.arange(int(shift / sampling + 1), stadatar.rflength) * sampling - shift
+    x_new = np.arange(0, stadatar.rflength) * sampling - shift
     for i in range(stadatar.ev_num):
-        Newaxis = np.array([])
         TempTpds = tps[i, :]
         StopIndex = np.where(np.imag(TempTpds) == 1)[0]
         if StopIndex.size == 0:
             StopIndex = dep_mod.depths.shape[0]
+        else:
+            StopIndex = StopIndex[0]
         EndIndex[i] = StopIndex - 1
-        Newaxis = np.append(Newaxis, np.append(np.arange(-shift, 0, sampling), 0))
-        for j in np.arange(int(shift / sampling + 1), stadatar.rflength):
-            Refaxis = j * sampling - shift
-            index = np.where(Refaxis <= tps[i, 0:StopIndex])[0]
-            if index.size == 0:
-                break
-            Ratio = (Tpds_ref[index[0]] - Tpds_ref[index[0] - 1]) / (tps[i, index[0]] - tps[i, index[0] - 1])
-            Newaxis = np.append(Newaxis, Tpds_ref[index[0] - 1] + (Refaxis - tps[i, index[0] - 1]) * Ratio)
+        # Search only the finite Ps times, i.e., without the NaN head of elevated stations
+        # and the NaN beyond the critical angle
+        is_finite = np.isfinite(TempTpds[0:StopIndex])
+        start = is_finite.argmax()
+        stop = start + np.append(is_finite[start:], False).argmin()
+        if stop - start < 2:
+            stop = start
+        # First depth whose Ps time reaches each sample; samples beyond the finite Ps times are dropped
+        # and samples ahead of the first depth are extrapolated from the first interval.
+        index = np.searchsorted(TempTpds[start:stop], Refaxis, side='left')
+        index = np.clip(index[0:np.searchsorted(index, stop - start)], 1, None) + start
+        Ratio = (Tpds_ref[index] - Tpds_ref[index - 1]) / (TempTpds[index] - TempTpds[index - 1])
+        Newaxis = np.append(head_axis, Tpds_ref[index - 1] + (Refaxis[0:index.size] - TempTpds[index - 1]) * Ratio)
         endidx = Newaxis.shape[0]
-        x_new = np.arange(0, stadatar.rflength) * sampling - shift
-        Tempdata = interp1d(Newaxis, data[i, 0:endidx], bounds_error=False)(x_new)
-        endIndice = np.where(np.isnan(Tempdata))[0]
-        if endIndice.size == 0:
-            New_data = Tempdata
-        else:
-            New_data = np.append(Tempdata[1:endIndice[0]], data[i, endidx+1:])
-        if New_data.shape[0] < stadatar.rflength:
-            Newdatar[i] = np.append(New_data, np.zeros(stadatar.rflength - New_data.shape[0]))
+        Tempdata = np.interp(x_new, Newaxis, data[i, 0:endidx], left=np.nan, right=np.nan)
+        is_nan = np.isnan(Tempdata)
+        if not is_nan.any():
+            Newdatar[i] = Tempdata
         else:
-            Newdatar[i] = New_data[0: stadatar.rflength]
+            # Corrected samples ahead of the first NaN followed by the remaining raw samples,
+            # written into the zero-filled row
+            New_data = Tempdata[1:is_nan.argmax()]
+            tail = data[i, endidx+1:endidx+1+stadatar.rflength-New_data.size]
+            Newdatar[i, 0:New_data.size] = New_data
+            Newdatar[i, New_data.size:New_data.size+tail.size] = tail
     return Newdatar, EndIndex
 
 
@@ -423,8 +609,9 @@ def psrf2depth(stadatar, YAxisRange, velmod='iasp91', srayp=None, normalize='sin
     """
     if exists(velmod):
         try:
-            dep_mod = DepModel(YAxisRange, velmod, elevation=stadatar.stel)
+            dep_mod = _cached_depmod(YAxisRange, velmod, stadatar.stel)
         except:
+            # vp and vs are replaced below, so the shared cached model cannot be used
             dep_mod = DepModel(YAxisRange, 'iasp91', elevation=stadatar.stel)
             try:
                 velmod_3d = np.load(velmod)
@@ -434,17 +621,13 @@ def psrf2depth(stadatar, YAxisRange, velmod='iasp91', srayp=None, normalize='sin
                 raise FileNotFoundError('Cannot load 1D or 3D velocity model of \'{}\''.format(velmod))
     else:
         try:
-            dep_mod = DepModel(YAxisRange, velmod, elevation=stadatar.stel)
+            dep_mod = _cached_depmod(YAxisRange, velmod, stadatar.stel)
         except:
             raise ValueError('Cannot recognize the velocity model of \'{}\''.format(velmod))
 
-    x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+    prayp = stadatar.rayp[:, np.newaxis]
     if srayp is None:
-        for i in range(stadatar.ev_num):
-            tps[i], x_s[i], x_p[i] = xps_tps_map(dep_mod, stadatar.rayp[i], 
-                stadatar.rayp[i], sphere=sphere, phase=phase)
+        tps, x_s, x_p = xps_tps_map(dep_mod, prayp, prayp, sphere=sphere, phase=phase)
     elif isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
         if isinstance(srayp, str):
             if not exists(srayp):
@@ -453,32 +636,52 @@ def psrf2depth(stadatar, YAxisRange, velmod='iasp91', srayp=None, normalize='sin
                 rayp_lib = np.load(srayp)
         else:
             rayp_lib = srayp
+        rayps = np.zeros([stadatar.ev_num, dep_mod.depths_elev.shape[0]])
         for i in range(stadatar.ev_num):
-            rayp = get_psrayp(rayp_lib, stadatar.dis[i], stadatar.evdp[i], dep_mod.depths_elev)
-            rayp = skm2srad(sdeg2skm(rayp))
-            tps[i], x_s[i], x_p[i] = xps_tps_map(dep_mod,
-                rayp, stadatar.rayp[i], sphere=sphere, phase=phase)
+            rayps[i] = get_psrayp(rayp_lib, stadatar.dis[i], stadatar.evdp[i], dep_mod.depths_elev)
+        rayps = skm2srad(sdeg2skm(rayps))
+        tps, x_s, x_p = xps_tps_map(dep_mod, rayps, prayp, sphere=sphere, phase=phase)
     else:
         raise TypeError('srayp should be path to Ps rayp lib')
     ps_rfdepth, endindex = time2depth(stadatar, dep_mod.depths, tps, normalize=normalize)
     return ps_rfdepth, endindex, x_s, x_p
 
 
-def xps_tps_map(dep_mod, srayp, prayp, is_raylen=False, sphere=True, phase=1):
+def _elev2depth(dep_mod, arr):
+    """Linearly interpolate ``arr`` from ``dep_mod.depths_elev`` to ``dep_mod.depths`` along the last axis.
+    Depths above ``depths_elev[0]`` are filled with NaN and those below ``depths_elev[-1]`` with the last value.
+    """
+    # Intervals and weights of the target depths are shared by all rows of arr. A depth on a node
+    # takes the interval to its left as interp1d does.
+    depths_elev = dep_mod.depths_elev
+    idx_lo = np.clip(np.searchsorted(depths_elev, dep_mod.depths, 'left') - 1, 0, depths_elev.size - 2)
+    idx_hi = idx_lo + 1
+    weight = (dep_mod.depths - depths_elev[idx_lo]) / (depths_elev[idx_hi] - depths_elev[idx_lo])
+    arr_lo = arr[..., idx_lo]
+    out = arr_lo + (arr[..., idx_hi] - arr_lo) * weight
+    out[..., dep_mod.depths < depths_elev[0]] = np.nan
+    out[..., dep_mod.depths > depths_elev[-1]] = arr[..., -1:]
+    return out
+
+
+def xps_tps_map(dep_mod, srayp, prayp, is_raylen=False, sphere=True, phase=1, backend='numpy'):
     """Calculate horizontal distance and time difference at depths
 
     :param dep_mod: 1D velocity model class 
     :type dep_mod: :meth:`seispy.util.DepModel`
-    :param srayp: conversion phase ray-parameters
-    :type srayp: float
-    :param prayp: S-wave ray-parameters
-    :type prayp: float
+    :param srayp: conversion phase ray-parameters. A 2-D array with shape of ``(ev_num, 1)`` or
+                  ``(ev_num, dep_mod.depths_elev.size)`` calculates all events at once.
+    :type srayp: float or numpy.ndarray
+    :param prayp: S-wave ray-parameters, a 2-D array with shape of ``(ev_num, 1)`` for all events.
+    :type prayp: float or numpy.ndarray
     :param is_raylen: Wether calculate ray length at depths, defaults to False
     :type is_raylen: bool, optional
     :param sphere: Wether do earth-flattening transformation, defaults to True, defaults to True
     :type sphere: bool, optional
     :param phase: Phases to calculate 1 for ``Ps``, 2 for ``PpPs``, 3 for ``PsPs+PpSs``, defaults to 1
     :type phase: int, optional
+    :param backend: ``'cupy'`` to calculate time differences and horizontal distances on GPU, defaults to 'numpy'
+    :type backend: str, optional
 
     Returns
     -----------
@@ -499,26 +702,36 @@ def xps_tps_map(dep_mod, srayp, prayp, is_raylen=False, sphere=True, phase=1):
     
     raylength_p: 2-D numpy.ndarray, float   
     """
-    x_s = dep_mod.radius_s(prayp, phase='S', sphere=sphere)
-    x_p = dep_mod.radius_s(prayp, phase='P', sphere=sphere)
+    if phase not in (1, 2, 3):
+        raise ValueError('Phase must be in 1 for Ps, 2 for PpPs, 3 for PsPs+PpSs')
+    if check_backend(backend) == 'cupy':
+        tps, x_s, x_p = _ray_integrals_cupy(dep_mod, srayp, prayp, sphere=sphere, phase=phase)
+    elif HAS_NUMBA and np.ndim(srayp) == 2 and np.ndim(prayp) == 2:
+        # All events at once in the jitted kernel, parallel over events
+        shape = (np.shape(prayp)[0], dep_mod.depths_elev.size)
+        tps, x_s, x_p = np.empty(shape), np.empty(shape), np.empty(shape)
+        radius = dep_mod.R if sphere else np.full(dep_mod.R.shape, 6371.)
+        _ray_integrals(np.asarray(srayp, dtype=float), np.asarray(prayp, dtype=float),
+                       dep_mod.vp, dep_mod.vs, radius, dep_mod.dz, phase, tps, x_s, x_p)
+    else:
+        x_s = dep_mod.radius_s(prayp, phase='S', sphere=sphere)
+        x_p = dep_mod.radius_s(prayp, phase='P', sphere=sphere)
+        if phase == 1:
+            tps = dep_mod.tpds(srayp, prayp, sphere=sphere)
+        elif phase == 2:
+            tps = dep_mod.tpppds(srayp, prayp, sphere=sphere)
+        else:
+            tps = dep_mod.tpspds(srayp, sphere=sphere)
     if is_raylen:
         raylength_s = dep_mod.raylength(srayp, phase='S', sphere=sphere)
         raylength_p = dep_mod.raylength(prayp, phase='P', sphere=sphere)
-    if phase == 1:
-        tps = dep_mod.tpds(srayp, prayp, sphere=sphere)
-    elif phase == 2:
-        tps = dep_mod.tpppds(srayp, prayp, sphere=sphere)
-    elif phase == 3:
-        tps = dep_mod.tpspds(srayp, sphere=sphere)
-    else:
-        raise ValueError('Phase must be in 1 for Ps, 2 for PpPs, 3 for PsPs+PpSs')
     if dep_mod.elevation != 0:
-        x_s = interp1d(dep_mod.depths_elev, x_s, bounds_error=False, fill_value=(np.nan, x_s[-1]))(dep_mod.depths)
-        x_p = interp1d(dep_mod.depths_elev, x_p, bounds_error=False, fill_value=(np.nan, x_p[-1]))(dep_mod.depths)
-        tps = interp1d(dep_mod.depths_elev, tps, bounds_error=False, fill_value=(np.nan, tps[-1]))(dep_mod.depths)
+        x_s = _elev2depth(dep_mod, x_s)
+        x_p = _elev2depth(dep_mod, x_p)
+        tps = _elev2depth(dep_mod, tps)
         if is_raylen:
-            raylength_s = interp1d(dep_mod.depths_elev, raylength_s, bounds_error=False, fill_value=(np.nan, raylength_s[-1]))(dep_mod.depths)
-            raylength_p = interp1d(dep_mod.depths_elev, raylength_p, bounds_error=False, fill_value=(np.nan, raylength_p[-1]))(dep_mod.depths)         
+            raylength_s = _elev2depth(dep_mod, raylength_s)
+            raylength_p = _elev2depth(dep_mod, raylength_p)
     if is_raylen:
         return tps, x_s, x_p, raylength_s, raylength_p
     else:
@@ -526,23 +739,17 @@ def xps_tps_map(dep_mod, srayp, prayp, is_raylen=False, sphere=True, phase=1):
 
 
 def psrf_1D_raytracing(stadatar, YAxisRange, velmod='iasp91', srayp=None, sphere=True, phase=1):
-    dep_mod = DepModel(YAxisRange, velmod, stadatar.stel)
-
-    # x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    raylength_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplat_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    # x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    raylength_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplat_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+    geom = _psrf_1D_raytracing(stadatar, YAxisRange, velmod=velmod, srayp=srayp, sphere=sphere, phase=phase)
+    return geom.pplat_s, geom.pplon_s, geom.pplat_p, geom.pplon_p, geom.raylength_s, geom.raylength_p, geom.tps
+
+
+def _psrf_1D_raytracing(stadatar, YAxisRange, velmod='iasp91', srayp=None, sphere=True, phase=1, backend='numpy'):
+    """See :func:`psrf_1D_raytracing`, returning the ray geometry as :class:`RayGeom`"""
+    dep_mod = _cached_depmod(YAxisRange, velmod, stadatar.stel)
+    geom = RayGeom(stadatar.ev_num, YAxisRange)
+    prayp = stadatar.rayp[:, np.newaxis]
     if srayp is None:
-        for i in range(stadatar.ev_num):
-            tps[i], x_s, x_p, raylength_s[i], raylength_p[i] = xps_tps_map(
-                dep_mod, stadatar.rayp[i], stadatar.rayp[i], is_raylen=True, sphere=sphere, phase=phase)
-            pplat_s[i], pplon_s[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_s))
-            pplat_p[i], pplon_p[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_p))
+        srayps = prayp
     elif isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
         if isinstance(srayp, str):
             if not exists(srayp):
@@ -551,21 +758,24 @@ def psrf_1D_raytracing(stadatar, YAxisRange, velmod='iasp91', srayp=None, sphere
                 rayp_lib = np.load(srayp)
         else:
             rayp_lib = srayp
+        srayps = np.zeros([stadatar.ev_num, dep_mod.depths_elev.shape[0]])
         for i in range(stadatar.ev_num):
-            rayp = get_psrayp(rayp_lib, stadatar.dis[i], stadatar.evdp[i], dep_mod.depths_elev)
-            rayp = skm2srad(sdeg2skm(rayp))
-            tps[i], x_s, x_p, raylength_s[i], raylength_p[i] = xps_tps_map(dep_mod, rayp, 
-                                        stadatar.rayp[i], is_raylen=True, sphere=sphere, phase=phase)
-            x_s = _imag2nan(x_s)
-            x_p = _imag2nan(x_p)
-            pplat_s[i], pplon_s[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_s))
-            pplat_p[i], pplon_p[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_p))
+            srayps[i] = get_psrayp(rayp_lib, stadatar.dis[i], stadatar.evdp[i], dep_mod.depths_elev)
+        srayps = skm2srad(sdeg2skm(srayps))
     else:
         raise TypeError('srayp should be path to Ps rayp lib')
-    return pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps
-
-
-def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sphere=True):
+    geom.tps[:], x_s, x_p, geom.raylength_s[:], geom.raylength_p[:] = xps_tps_map(
+        dep_mod, srayps, prayp, is_raylen=True, sphere=sphere, phase=phase, backend=backend)
+    if srayp is not None:
+        x_s = _imag2nan(x_s)
+        x_p = _imag2nan(x_p)
+    bazi = stadatar.bazi[:, np.newaxis]
+    geom.pplat_s[:], geom.pplon_s[:] = latlon_from(stadatar.stla, stadatar.stlo, bazi, rad2deg(x_s))
+    geom.pplat_p[:], geom.pplon_p[:] = latlon_from(stadatar.stla, stadatar.stlo, bazi, rad2deg(x_p))
+    return geom
+
+
+def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sphere=True, backend='numpy'):
     """
     Back ray trace the S wavs with a assumed ray parameter of P.
 
@@ -578,6 +788,8 @@ def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sph
     :type mod3d: 'Mod3DPerturbation' object
     :param elevation: Elevation of this station relative to sea level
     :type elevation: float
+    :param backend: ``'cupy'`` to interpolate the 3D model on GPU, defaults to 'numpy'
+    :type backend: str, optional
     :return: pplat_s, pplon_s, pplat_p, pplon_p, tps
     :type: numpy.ndarray * 5
     """
@@ -586,15 +798,14 @@ def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sph
     else:
         R = 6371.0 + elevation
     dep_range = YAxisRange.copy()
-    YAxisRange -= elevation
+    YAxisRange = YAxisRange - elevation
     ddepth = np.mean(np.diff(YAxisRange))
-    pplat_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplat_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+    geom = RayGeom(stadatar.ev_num, YAxisRange)
+    pplat_s, pplon_s, pplat_p, pplon_p = geom.pplat_s, geom.pplon_s, geom.pplat_p, geom.pplon_p
     x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
     x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+    vs = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+    vp = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
     rayps = srad2skm(stadatar.rayp)
 
     if isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
@@ -605,49 +816,118 @@ def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sph
                 rayp_lib = np.load(srayp)
         else:
             rayp_lib = srayp
+        srayps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+        for i in range(stadatar.ev_num):
+            srayps[i] = get_psrayp(rayp_lib, stadatar.dis[i],
+                                   stadatar.evdp[i], YAxisRange)
+        srayps = skm2srad(sdeg2skm(srayps))
     elif srayp is None:
-        pass
+        srayps = stadatar.rayp[:, np.newaxis]
     else:
         raise TypeError('srayp should be path to Ps rayp lib')
 
-    for i in range(stadatar.ev_num):
-        if srayp is None:
-            srayps = stadatar.rayp[i]
+    grid = (mod3d.model['dep'], mod3d.model['lat'], mod3d.model['lon'])
+    pplat_s[:, 0] = pplat_p[:, 0] = stadatar.stla
+    pplon_s[:, 0] = pplon_p[:, 0] = stadatar.stlo
+    if HAS_NUMBA and check_backend(backend) == 'numpy':
+        _raytracing_3d(float(stadatar.stla), float(stadatar.stlo),
+                       stadatar.bazi.astype(float), rayps.astype(float),
+                       YAxisRange.astype(float), float(ddepth),
+                       *[np.ascontiguousarray(g, dtype=float) for g in grid],
+                       np.ascontiguousarray(mod3d.model['vs'], dtype=float),
+                       np.ascontiguousarray(mod3d.model['vp'], dtype=float),
+                       pplat_s, pplon_s, pplat_p, pplon_p, x_s, x_p, vs, vp)
+    else:
+        if check_backend(backend) == 'cupy':
+            # The model stays on the device, only the conversion points of each depth are transferred
+            interp_vs = lambda points: mod3d._interp_on_device('vs', points)
+            interp_vp = lambda points: mod3d._interp_on_device('vp', points)
         else:
-            srayps = get_psrayp(rayp_lib, stadatar.dis[i],
-                                stadatar.evdp[i], YAxisRange)
-            srayps = skm2srad(sdeg2skm(srayps))
-        pplat_s[i][0] = pplat_p[i][0] = stadatar.stla
-        pplon_s[i][0] = pplon_p[i][0] = stadatar.stlo
-        x_s[i][0] = 0
-        x_p[i][0] = 0
-        vs = np.zeros_like(YAxisRange)
-        vp = np.zeros_like(YAxisRange)
-        for j, dep in enumerate(YAxisRange[:-1]):
-            vs[j] = interpn((mod3d.model['dep'], mod3d.model['lat'], mod3d.model['lon']),
-                            mod3d.model['vs'], (dep, pplat_s[i, j], pplon_s[i, j]),
-                            bounds_error=False, fill_value=None)
-            vp[j] = interpn((mod3d.model['dep'], mod3d.model['lat'], mod3d.model['lon']),
-                            mod3d.model['vp'], (dep, pplat_p[i, j], pplon_p[i, j]),
-                            bounds_error=False, fill_value=None)
-            x_s[i, j+1] = ddepth*tand(asind(vs[j]*rayps[i])) + x_s[i, j]
-            x_p[i, j+1] = ddepth*tand(asind(vp[j]*rayps[i])) + x_p[i, j]
-            pplat_s[i, j+1], pplon_s[i, j+1] = latlon_from(stadatar.stla,
+            interp_vs = RegularGridInterpolator(grid, mod3d.model['vs'], bounds_error=False, fill_value=None)
+            interp_vp = RegularGridInterpolator(grid, mod3d.model['vp'], bounds_error=False, fill_value=None)
+        # Each depth depends on the conversion points of the previous one,
+        # so march along depth and query the model for all events at once.
+        for j, dep in enumerate(YAxisRange):
+            deps = np.full(stadatar.ev_num, dep)
+            vs[:, j] = interp_vs(np.column_stack((deps, pplat_s[:, j], pplon_s[:, j])))
+            vp[:, j] = interp_vp(np.column_stack((deps, pplat_p[:, j], pplon_p[:, j])))
+            if j == YAxisRange.shape[0] - 1:
+                break
+            x_s[:, j+1] = ddepth*tand(asind(vs[:, j]*rayps)) + x_s[:, j]
+            x_p[:, j+1] = ddepth*tand(asind(vp[:, j]*rayps)) + x_p[:, j]
+            pplat_s[:, j+1], pplon_s[:, j+1] = latlon_from(stadatar.stla,
                                                            stadatar.stlo,
-                                                           stadatar.bazi[i],
-                                                           km2deg(x_s[i, j+1]))
-            pplat_p[i, j+1], pplon_p[i, j+1] = latlon_from(stadatar.stla,
+                                                           stadatar.bazi,
+                                                           km2deg(x_s[:, j+1]))
+            pplat_p[:, j+1], pplon_p[:, j+1] = latlon_from(stadatar.stla,
                                                            stadatar.stlo,
-                                                           stadatar.bazi[i],
-                                                           km2deg(x_p[i, j+1]))
-        tps_corr = np.cumsum((np.sqrt((R / vs) ** 2 - srayps ** 2) -
-                            np.sqrt((R / vp) ** 2 - stadatar.rayp[i] ** 2))
-                            * (ddepth / R))
-        if elevation != 0:
-            tps[i] = interp1d(YAxisRange, tps_corr)(dep_range)
+                                                           stadatar.bazi,
+                                                           km2deg(x_p[:, j+1]))
+    tps = np.cumsum((np.sqrt((R / vs) ** 2 - srayps ** 2) -
+                     np.sqrt((R / vp) ** 2 - stadatar.rayp[:, np.newaxis] ** 2))
+                    * (ddepth / R), axis=1)
+    if elevation != 0:
+        tps = interp1d(YAxisRange, tps, axis=1, bounds_error=False, fill_value=(np.nan, tps[:, -1]),
+                       assume_sorted=True, copy=False)(dep_range)
     return pplat_s, pplon_s, pplat_p, pplon_p, tps
 
 
+@njit(fastmath=FASTMATH)
+def _grid_cell(grid, x):
+    """Lower node index and weight of ``x`` in ``grid``, extrapolating at the edges
+    as :class:`scipy.interpolate.RegularGridInterpolator`.
+    """
+    idx = np.searchsorted(grid, x) - 1
+    idx = min(max(idx, 0), grid.shape[0] - 2)
+    return idx, (x - grid[idx]) / (grid[idx+1] - grid[idx])
+
+
+@njit(fastmath=FASTMATH)
+def _trilinear(grid_dep, grid_lat, grid_lon, values, dep, lat, lon):
+    i, wi = _grid_cell(grid_dep, dep)
+    j, wj = _grid_cell(grid_lat, lat)
+    k, wk = _grid_cell(grid_lon, lon)
+    value = 0.
+    for di in range(2):
+        fi = wi if di else 1. - wi
+        for dj in range(2):
+            fj = wj if dj else 1. - wj
+            for dk in range(2):
+                fk = wk if dk else 1. - wk
+                value += fi * fj * fk * values[i+di, j+dj, k+dk]
+    return value
+
+
+@njit(fastmath=FASTMATH)
+def _latlon_from(lat1, lon1, azimuth, gcarc_dist):
+    """Scalar version of :func:`seispy.geo.latlon_from` for the jitted ray tracing."""
+    lat1r = math.radians(lat1)
+    azr = math.radians(azimuth)
+    gcr = math.radians(gcarc_dist)
+    lat2r = np.arcsin(math.sin(lat1r) * math.cos(gcr) + math.cos(lat1r) * math.sin(gcr) * math.cos(azr))
+    lon2 = lon1 + math.degrees(np.arcsin(math.sin(gcr) * math.sin(azr) / math.cos(lat2r)))
+    if not math.cos(gcr) >= math.sin(lat1r) * math.sin(lat2r):
+        lon2 += 180
+    return math.degrees(lat2r), lon2
+
+
+@njit(parallel=True, fastmath=FASTMATH)
+def _raytracing_3d(stla, stlo, bazi, rayps, dep_axis, ddepth, grid_dep, grid_lat, grid_lon, mod_vs, mod_vp,
+                   pplat_s, pplon_s, pplat_p, pplon_p, x_s, x_p, vs, vp):
+    """March the S and P rays of all events downward through the 3D model, see :func:`psrf_3D_raytracing`."""
+    ev_num, ndep = x_s.shape
+    for i in prange(ev_num):
+        for j in range(ndep):
+            vs[i, j] = _trilinear(grid_dep, grid_lat, grid_lon, mod_vs, dep_axis[j], pplat_s[i, j], pplon_s[i, j])
+            vp[i, j] = _trilinear(grid_dep, grid_lat, grid_lon, mod_vp, dep_axis[j], pplat_p[i, j], pplon_p[i, j])
+            if j == ndep - 1:
+                break
+            x_s[i, j+1] = ddepth * math.tan(np.arcsin(vs[i, j] * rayps[i])) + x_s[i, j]
+            x_p[i, j+1] = ddepth * math.tan(np.arcsin(vp[i, j] * rayps[i])) + x_p[i, j]
+            pplat_s[i, j+1], pplon_s[i, j+1] = _latlon_from(stla, stlo, bazi[i], x_s[i, j+1] * 180 / (math.pi * 6371))
+            pplat_p[i, j+1], pplon_p[i, j+1] = _latlon_from(stla, stlo, bazi[i], x_p[i, j+1] * 180 / (math.pi * 6371))
+
+
 def interp_depth_model(model, lat, lon, new_dep):
     """ Interpolate Vp and Vs from 3D velocity with a specified depth range.
 
@@ -670,13 +950,18 @@ def interp_depth_model(model, lat, lon, new_dep):
         Vs in ``new_dep``
     """
     #  model = np.load(modpath)
-    points = [[depth, lat, lon] for depth in new_dep]
-    vp = interpn((model['dep'], model['lat'], model['lon']), model['vp'], points, bounds_error=False, fill_value=None)
-    vs = interpn((model['dep'], model['lat'], model['lon']), model['vs'], points, bounds_error=False, fill_value=None)
+    # Trilinear interpolation at a fixed position is separable: one horizontal bilinear pass
+    # for Vp and Vs together gives the 1D profiles, which are then interpolated in depth.
+    vel = np.stack((model['vp'], model['vs']), axis=-1).transpose(1, 2, 0, 3)
+    profile = RegularGridInterpolator((model['lat'], model['lon']), vel,
+                                      bounds_error=False, fill_value=None)([lat, lon])[0]
+    vp, vs = interp1d(model['dep'], profile, axis=0, bounds_error=False,
+                      fill_value='extrapolate', assume_sorted=True, copy=False)(new_dep).T
     return vp, vs
 
 
-def psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, Tpds, dep_range, mod3d):
+def psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, Tpds, dep_range, mod3d,
+                      backend='numpy'):
     """ 3D time difference correction with specified ray path and 3D velocity model. 
         The input parameters can be generated with :meth:`psrf_1D_raytracing`.
 
@@ -700,25 +985,66 @@ def psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength
         1D array of depths in km, (``dep_range.size``)
     mod3d : :meth:`np.lib.npyio.NpzFile`
         3D velocity loaded from a ``.npz`` file
+    backend : str, optional
+        ``'cupy'`` to interpolate the 3D model on GPU, by default 'numpy'
 
     Returns
     -------
     :meth:`np.ndarray`
         Corrected time difference in dep_range
     """
-    ev_num, _ = raylength_p.shape
-    timecorrections = np.zeros_like(raylength_p)
-    for i in range(ev_num):
-        points = np.array([dep_range, pplat_p[i], pplon_p[i]]).T
-        dvp = mod3d.interpdvp(points)
-        points = np.array([dep_range, pplat_s[i], pplon_s[i]]).T
-        dvs = mod3d.interpdvs(points)
-        dlp = raylength_p[i]
-        dls = raylength_s[i]
-        tmpds = (dls / (mod3d.cvs * (1 + dvs)) - dls / mod3d.cvs) - (dlp / (mod3d.cvp * (1 + dvp)) - dlp / mod3d.cvp)
-        tmpds[np.isnan(tmpds)] = 0
-        timecorrections[i] = np.cumsum(tmpds)
-    return Tpds + timecorrections
+    ev_num, ndep = raylength_p.shape
+    deps = np.broadcast_to(dep_range, (ev_num, ndep))
+    points_s = np.stack((deps, pplat_s, pplon_s), axis=-1).reshape(-1, 3)
+    points_p = np.stack((deps, pplat_p, pplon_p), axis=-1).reshape(-1, 3)
+    return _psrf_3D_migration(points_s, points_p, raylength_s, raylength_p, Tpds, mod3d, backend=backend)
+
+
+def _psrf_3D_migration(points_s, points_p, raylength_s, raylength_p, Tpds, mod3d, backend='numpy', out=None):
+    """See :func:`psrf_3D_migration`. ``points_s`` and ``points_p`` are (dep, lat, lon) of conversion
+    points with shape of (``ev_num*ndep``, 3), e.g., :meth:`RayGeom.points_s` and :meth:`RayGeom.points_p`.
+    The corrected time differences are written into ``out`` if given, which may be ``Tpds`` itself.
+    """
+    ev_num, ndep = raylength_p.shape
+    # Query the perturbations at all conversion points of the station at once
+    dvp_all = mod3d.interpdvp(points_p, backend=backend).reshape(ev_num, ndep)
+    dvs_all = mod3d.interpdvs(points_s, backend=backend).reshape(ev_num, ndep)
+    if out is None:
+        out = np.empty((ev_num, ndep))
+    if HAS_NUMBA:
+        # Fused correction, accumulation and addition without (ev_num, ndep) temporaries
+        _time_correct(raylength_s, raylength_p, mod3d.cvs, mod3d.cvp, dvs_all, dvp_all,
+                      np.broadcast_to(Tpds, (ev_num, ndep)), out)
+        return out
+    # Velocities of the 1D model broadcast along depth for all events
+    # dl/(cv(1+dv)) - dl/cv = -dl*dv/(cv(1+dv)), evaluated in place to limit (ev_num, ndep) temporaries
+    denom = np.add(dvp_all, 1)
+    denom *= mod3d.cvp
+    tmpds = np.multiply(raylength_p, dvp_all)
+    tmpds /= denom
+    np.add(dvs_all, 1, out=denom)
+    denom *= mod3d.cvs
+    term_s = np.multiply(raylength_s, dvs_all)
+    term_s /= denom
+    tmpds -= term_s
+    np.nan_to_num(tmpds, copy=False, nan=0., posinf=np.inf, neginf=-np.inf)
+    timecorrections = np.cumsum(tmpds, axis=1, out=tmpds)
+    return np.add(Tpds, timecorrections, out=out)
+
+
+@njit(parallel=True, fastmath=FASTMATH)
+def _time_correct(dls, dlp, cvs, cvp, dvs, dvp, Tpds, out):
+    """Add the cumulative 3D time correction to ``Tpds`` for all events, see :func:`psrf_3D_migration`.
+    Corrections of NaN, e.g., beyond the critical angle, are skipped.
+    """
+    ev_num, ndep = out.shape
+    for i in prange(ev_num):
+        acc = 0.
+        for k in range(ndep):
+            d = dlp[i, k] * dvp[i, k] / (cvp[k] * (1 + dvp[i, k])) - dls[i, k] * dvs[i, k] / (cvs[k] * (1 + dvs[i, k]))
+            if d == d:
+                acc += d
+            out[i, k] = Tpds[i, k] + acc
 
 
 def time2depth(stadatar, dep_range, Tpds, normalize='single'):
@@ -745,32 +1071,69 @@ def time2depth(stadatar, dep_range, Tpds, normalize='single'):
     """
     if normalize:
         stadatar.normalize(method=normalize)
-    PS_RFdepth = np.zeros([stadatar.ev_num, dep_range.shape[0]])
+    PS_RFdepth = np.zeros([stadatar.ev_num, dep_range.shape[0]], dtype=np.float32)
     EndIndex = np.zeros(stadatar.ev_num).astype(int)
-    for i in range(stadatar.ev_num):
-        TempTpds = Tpds[i, :]
-        StopIndex = np.where(np.imag(TempTpds) == 1)[0]
-        if StopIndex.size == 0:
-            EndIndex[i] = dep_range.size - 1
-            # DepthAxis = interp1d(TempTpds, dep_range, bounds_error=False)(stadatar.time_axis)
-        else:
-            EndIndex[i] = StopIndex[0] - 1
-            # DepthAxis = interp1d(TempTpds[0:StopIndex], dep_range[0: StopIndex], bounds_error=False)(stadatar.time_axis)
-
-        PS_RFTempAmps = stadatar.__dict__['data{}'.format(stadatar.comp.lower())][i]
-        ValueIndices = np.where(np.logical_not(np.isnan(dep_range[0:EndIndex[i]+1])))[0]
-        if ValueIndices.size == 0:
-            continue
-        elif np.max(ValueIndices) > PS_RFTempAmps.shape[0]:
-            continue
-        else:
-            PS_RFAmps = interp1d(stadatar.time_axis, PS_RFTempAmps, bounds_error=False)(TempTpds[0:EndIndex[i]+1])
-            PS_RFdepth[i] = PS_RFAmps
+    rf_all = stadatar.rf_data
+    time_axis = stadatar.time_axis
+    is_stop = np.imag(Tpds) == 1
+    stops = np.where(is_stop.any(axis=1), is_stop.argmax(axis=1), dep_range.size)
+    EndIndex[:] = stops - 1
+    # Convert only events with a valid depth above the stop depth, judged by the last one of them
+    valid_idx = np.flatnonzero(~np.isnan(dep_range))
+    n_valid = np.searchsorted(valid_idx, stops)
+    is_conv = n_valid > 0
+    is_conv[is_conv] = valid_idx[n_valid[is_conv] - 1] <= rf_all.shape[1]
+    if HAS_NUMBA:
+        _t2d(np.ascontiguousarray(np.real(Tpds), dtype=float), stops, is_conv,
+             time_axis.astype(float), rf_all, PS_RFdepth)
+        return PS_RFdepth, EndIndex
+
+    def _conv_one(i):
+        stop = stops[i]
+        _interp_linear(time_axis, rf_all[i], Tpds[i, 0:stop], out=PS_RFdepth[i, 0:stop])
+
+    # NumPy releases the GIL during the interpolation and each event writes its own row
+    with ThreadPoolExecutor(max_workers=_default_workers()) as pool:
+        list(pool.map(_conv_one, np.flatnonzero(is_conv)))
     return PS_RFdepth, EndIndex
 
 
-if __name__ == '__main__':
-    rfsta = SACStation('/Users/xumijian/Codes/seispy-example/ex-ccp/RFresult/ZX.212/ZX.212finallist.dat')
-    rfsta.jointani(2, 7, weight=[0.9, 0.1, 0.0])
-    rfsta.ani.plot_polar()
-
+@njit(parallel=True, fastmath=FASTMATH)
+def _t2d(Tpds, stops, is_conv, time_axis, rf_all, PS_RFdepth):
+    """Interpolate RFs of events in ``is_conv`` at their time differences above the stop depths,
+    see :func:`time2depth`
+    """
+    ev_num = Tpds.shape[0]
+    nt = time_axis.shape[0]
+    for i in prange(ev_num):
+        if not is_conv[i]:
+            continue
+        stop = stops[i]
+        # Time differences increase with depth, so the node index only moves forward;
+        # search again only if a time difference goes backward.
+        j = 0
+        for k in range(stop):
+            t = Tpds[i, k]
+            if not (time_axis[0] <= t <= time_axis[nt-1]):
+                PS_RFdepth[i, k] = np.nan
+                continue
+            if j > 0 and t <= time_axis[j]:
+                j = max(np.searchsorted(time_axis, t) - 1, 0)
+            while j < nt - 2 and time_axis[j+1] < t:
+                j += 1
+            PS_RFdepth[i, k] = rf_all[i, j] + (rf_all[i, j+1] - rf_all[i, j]) * \
+                ((t - time_axis[j]) / (time_axis[j+1] - time_axis[j]))
+
+
+def _interp_linear(x, y, xnew, out=None):
+    """Linear interpolation of ``y`` at ``xnew`` with ascending ``x``. Values out of the range of ``x``
+    are NaN, the same as ``interp1d(x, y, bounds_error=False)(xnew)`` but without constructing the interpolator.
+    """
+    if out is None:
+        out = np.empty(np.shape(xnew), dtype=np.result_type(y, float))
+    idx = np.clip(np.searchsorted(x, xnew) - 1, 0, x.size - 2)
+    x_lo = x[idx]
+    y_lo = y[idx]
+    np.add(y_lo, (y[idx+1] - y_lo) * ((xnew - x_lo) / (x[idx+1] - x_lo)), out=out)
+    out[~((xnew >= x[0]) & (xnew <= x[-1]))] = np.nan
+    return out
@@ -1,15 +1,46 @@
 from os.path import join, dirname, exists, abspath
-from scipy.io import loadmat
-from matplotlib.colors import ListedColormap
 from seispy import geo
 from seispy.geo import geo2sph, km2deg, skm2srad, sph2geo, srad2skm
 from seispy import distaz
 import numpy as np
-from scipy.interpolate import interp1d, interpn
+from scipy.interpolate import interp1d, RegularGridInterpolator
 import seispy
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """Stand-in of :func:`numba.njit` returning the function untouched when numba is not installed."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+def _import_cupy():
+    """Import CuPy for the GPU backend (``backend='cupy'``)"""
+    try:
+        import cupy
+    except ImportError:
+        raise ImportError('CuPy is required for backend=\'cupy\'')
+    return cupy
+
+
+def check_backend(backend):
+    if backend not in ('numpy', 'cupy'):
+        raise ValueError('backend must be in \'numpy\' or \'cupy\'')
+    return backend
+
+
+# fastmath flags without ``nnan`` and ``ninf``, because NaN marks the rays beyond the critical angle
+FASTMATH = {'nsz', 'arcp', 'contract', 'afn'}
 
 
 def load_cyan_map():
+    from scipy.io import loadmat
+    from matplotlib.colors import ListedColormap
     path = join(dirname(__file__), 'data', 'cyan.mat')
     carray = loadmat(path)['cyan']
     return ListedColormap(carray)
@@ -78,7 +109,7 @@ class DepModel(object):
             radius = 6371.
         tps = np.cumsum((np.sqrt((radius / self.vs) ** 2 - rayps ** 2) -
                         np.sqrt((radius / self.vp) ** 2 - raypp ** 2)) *
-                        (self.dz / radius))
+                        (self.dz / radius), axis=-1)
         return tps
     
     def tpppds(self, rayps, raypp, sphere=True):
@@ -88,7 +119,7 @@ class DepModel(object):
             radius = 6371.
         tps = np.cumsum((np.sqrt((radius / self.vs) ** 2 - rayps ** 2) +
                         np.sqrt((radius / self.vp) ** 2 - raypp ** 2)) *
-                        (self.dz / radius))
+                        (self.dz / radius), axis=-1)
         return tps
     
     def tpspds(self, rayps, sphere=True):
@@ -97,7 +128,7 @@ class DepModel(object):
         else:
             radius = 6371.
         tps = np.cumsum(2*np.sqrt((radius / self.vs) ** 2 - rayps ** 2)*
-                        (self.dz / radius))
+                        (self.dz / radius), axis=-1)
         return tps
 
     def radius_s(self, rayp, phase='P', sphere=True):
@@ -109,7 +140,7 @@ class DepModel(object):
             radius = self.R
         else:
             radius = 6371.
-        hor_dis = np.cumsum((self.dz / radius) / np.sqrt((1. / (rayp ** 2. * (radius / vel) ** -2)) - 1))
+        hor_dis = np.cumsum((self.dz / radius) / np.sqrt((1. / (rayp ** 2. * (radius / vel) ** -2)) - 1), axis=-1)
         return hor_dis
 
     def raylength(self, rayp, phase='P', sphere=True):
@@ -125,6 +156,64 @@ class DepModel(object):
         return raylen
 
 
+@njit(parallel=True, fastmath=FASTMATH)
+def _ray_integrals(srayp, prayp, vp, vs, radius, dz, phase, tps, x_s, x_p):
+    """Accumulate time differences and horizontal distances of all events along depth in place,
+    the same as :meth:`DepModel.tpds`, :meth:`DepModel.tpppds`, :meth:`DepModel.tpspds`
+    and :meth:`DepModel.radius_s`.
+
+    :param srayp: Ray-parameters of the conversion phase with shape of ``(ev_num, 1)`` or ``(ev_num, ndep)``
+    :param prayp: Ray-parameters of P-wave with shape of ``(ev_num, 1)``
+    :param phase: 1 for ``Ps``, 2 for ``PpPs``, 3 for ``PsPs+PpSs``
+    """
+    ev_num, ndep = tps.shape
+    for i in prange(ev_num):
+        acc_t = 0.
+        acc_s = 0.
+        acc_p = 0.
+        pp = prayp[i, 0]
+        for j in range(ndep):
+            sp = srayp[i, j] if srayp.shape[1] > 1 else srayp[i, 0]
+            slow_s = radius[j] / vs[j]
+            slow_p = radius[j] / vp[j]
+            dr = dz[j] / radius[j]
+            qs = np.sqrt(slow_s ** 2 - sp ** 2)
+            qp = np.sqrt(slow_p ** 2 - pp ** 2)
+            if phase == 1:
+                acc_t += (qs - qp) * dr
+            elif phase == 2:
+                acc_t += (qs + qp) * dr
+            else:
+                acc_t += 2 * qs * dr
+            acc_s += dr / np.sqrt(1. / (pp ** 2. * slow_s ** -2) - 1)
+            acc_p += dr / np.sqrt(1. / (pp ** 2. * slow_p ** -2) - 1)
+            tps[i, j] = acc_t
+            x_s[i, j] = acc_s
+            x_p[i, j] = acc_p
+
+
+def _ray_integrals_cupy(dep_mod, srayp, prayp, sphere=True, phase=1):
+    """GPU version of :func:`_ray_integrals` with CuPy, returning ``tps``, ``x_s`` and ``x_p`` as NumPy arrays"""
+    cp = _import_cupy()
+    radius = cp.asarray(dep_mod.R) if sphere else 6371.
+    slow_s = radius / cp.asarray(dep_mod.vs)
+    slow_p = radius / cp.asarray(dep_mod.vp)
+    dr = cp.asarray(dep_mod.dz) / radius
+    srayp = cp.asarray(srayp, dtype=float)
+    prayp = cp.asarray(prayp, dtype=float)
+    qs = cp.sqrt(slow_s ** 2 - srayp ** 2)
+    if phase == 1:
+        dtps = qs - cp.sqrt(slow_p ** 2 - prayp ** 2)
+    elif phase == 2:
+        dtps = qs + cp.sqrt(slow_p ** 2 - prayp ** 2)
+    else:
+        dtps = 2 * qs
+    tps = cp.cumsum(dtps * dr, axis=-1)
+    x_s = cp.cumsum(dr / cp.sqrt(1. / (prayp ** 2. * slow_s ** -2) - 1), axis=-1)
+    x_p = cp.cumsum(dr / cp.sqrt(1. / (prayp ** 2. * slow_p ** -2) - 1), axis=-1)
+    return cp.asnumpy(tps), cp.asnumpy(x_s), cp.asnumpy(x_p)
+
+
 class Mod3DPerturbation:
     def __init__(self, modpath, YAxisRange, velmod='iasp91'):
         dep_mod = DepModel(YAxisRange, velmod=velmod)
@@ -137,15 +226,41 @@ class Mod3DPerturbation:
         self.dvs = (self.model['vs'] - new1dvs) / new1dvs
         self.cvp = dep_mod.vp
         self.cvs = dep_mod.vs
+        grid = (self.model['dep'], self.model['lat'], self.model['lon'])
+        self._interp_dvp = RegularGridInterpolator(grid, self.dvp, bounds_error=False, fill_value=None)
+        self._interp_dvs = RegularGridInterpolator(grid, self.dvs, bounds_error=False, fill_value=None)
+        self._device_interps = {}
+
+    def device_interp(self, key):
+        """Interpolator on GPU of ``dvp``, ``dvs``, ``vp`` or ``vs``. The grids are copied to the device
+        at the first call and kept there for the following calls.
+        """
+        if key not in self._device_interps:
+            cp = _import_cupy()
+            from cupyx.scipy.interpolate import RegularGridInterpolator as DeviceRegularGridInterpolator
+            if key in ('dvp', 'dvs'):
+                values = self.__dict__[key]
+            else:
+                values = self.model[key]
+            grid = tuple(cp.asarray(self.model[k]) for k in ('dep', 'lat', 'lon'))
+            self._device_interps[key] = DeviceRegularGridInterpolator(grid, cp.asarray(values),
+                                                                      bounds_error=False, fill_value=None)
+        return self._device_interps[key]
+
+    def _interp_on_device(self, key, points):
+        cp = _import_cupy()
+        return cp.asnumpy(self.device_interp(key)(cp.asarray(points)))
 
-    def interpdvp(self, points):
-        dvp = interpn((self.model['dep'], self.model['lat'], self.model['lon']), self.dvp, points,
-                      bounds_error=False, fill_value=None)
+    def interpdvp(self, points, backend='numpy'):
+        if check_backend(backend) == 'cupy':
+            return self._interp_on_device('dvp', points)
+        dvp = self._interp_dvp(points)
         return dvp
 
-    def interpdvs(self, points):
-        dvs = interpn((self.model['dep'], self.model['lat'], self.model['lon']), self.dvs, points,
-                      bounds_error=False, fill_value=None)
+    def interpdvs(self, points, backend='numpy'):
+        if check_backend(backend) == 'cupy':
+            return self._interp_on_device('dvs', points)
+        dvs = self._interp_dvs(points)
         return dvs
 
 
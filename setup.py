@@ -21,7 +21,7 @@ setup(name='python-seispy',
                 'obspy>=1.3.0',
                 'pandas>=1.0.0',
                 'numpy>=1.19.0',
-                'scipy>=1.1.0',
+                'scipy>=1.4.0',
                 'matplotlib>=3.2.0',
                 'pyqt5>=5.12.0',
                 # 'pyqtwebengine>=5.12.0'
@@ -1,4 +1,9 @@
-from seispy.rfcorrect import RFStation
+from seispy.rfcorrect import RFStation, psrf_1D_raytracing, psrf_3D_raytracing, psrf_3D_migration, \
+                             time2depth, xps_tps_map
+from seispy.utils import DepModel, Mod3DPerturbation
+from seispy.geo import skm2srad
+import seispy.rfcorrect
+import numpy as np
 import pytest
 from os.path import exists
 from subprocess import Popen
@@ -40,4 +45,62 @@ def test_sub04():
     rfs = RFStation('ex-rfani/SC.LTA')
     rfs.resample(0.1)
     plotr(rfs, outpath='./', xlim=[-2, 80], key='bazi', enf=6, format='pdf')
-    plotrt(rfs, enf=3, out_path='./', key='bazi', outformat='g', xmax=30)
\ No newline at end of file
+    plotrt(rfs, enf=3, out_path='./', key='bazi', outformat='g', xmax=30)
+
+
+def test_sub05():
+    rfs = RFStation('ex-rfani/SC.LTA', n_workers=1)
+    rfs_mmap = RFStation('ex-rfani/SC.LTA', mmap=True)
+    assert np.allclose(rfs.datar, rfs_mmap.datar)
+    assert np.allclose(rfs.datat, rfs_mmap.datat)
+
+
+def test_sub06():
+    for method in ['poly', 'fft', 'lanczos']:
+        rfs = RFStation('ex-rfani/SC.LTA')
+        rfs.resample(0.05, method=method)
+        assert rfs.datar.shape == (rfs.ev_num, rfs.rflength)
+        assert rfs.time_axis.size == rfs.rflength
+
+
+def test_sub07(tmp_path, monkeypatch):
+    pytest.importorskip('numba')
+    rfs = RFStation('ex-rfani/SC.LTA')
+    rfs.normalize()
+    dep_range = np.arange(0, 150, 1.)
+    dep = np.arange(0, 201, 10.)
+    lat = np.arange(rfs.stla - 3, rfs.stla + 3.1, 0.5)
+    lon = np.arange(rfs.stlo - 3, rfs.stlo + 3.1, 0.5)
+    d, la, lo = np.meshgrid(dep, lat, lon, indexing='ij')
+    vp = 5.8 + 0.02 * d + 0.1 * np.sin(la) + 0.1 * np.cos(lo)
+    vs = vp / 1.75 + 0.05 * np.cos(2 * la)
+    modpath = str(tmp_path / 'mod3d.npz')
+    np.savez(modpath, dep=dep, lat=lat, lon=lon, vp=vp, vs=vs)
+    mod3d = Mod3DPerturbation(modpath, dep_range)
+    dep_mod = DepModel(dep_range, 'iasp91', rfs.stel)
+    pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps = psrf_1D_raytracing(rfs, dep_range)
+    results = []
+    for has_numba in [False, True]:
+        monkeypatch.setattr(seispy.rfcorrect, 'HAS_NUMBA', has_numba)
+        res = list(psrf_3D_raytracing(rfs, dep_range, mod3d))
+        res += list(xps_tps_map(dep_mod, rfs.rayp[:, np.newaxis], rfs.rayp[:, np.newaxis]))
+        tps_3d = psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p,
+                                   tps, dep_range, mod3d)
+        res += [tps_3d]
+        res += list(time2depth(rfs, dep_range, tps_3d, normalize=None))
+        results.append(res)
+    for a, b in zip(*results):
+        assert np.array_equal(np.isnan(a), np.isnan(b))
+        assert np.allclose(a, b, rtol=1e-5, atol=1e-5, equal_nan=True)
+
+
+def test_sub08():
+    # A post-critical event gives NaN Ps times at depth, and an elevation of a multiple
+    # of the depth step puts NaN next to nodes of the elevation-shifted depths
+    for stel in [0., 1000.]:
+        rfs = RFStation('ex-rfani/SC.LTA')
+        rfs.rayp[0] = skm2srad(0.15)
+        rfs.stel = stel
+        rf_corr, t_corr = rfs.moveoutcorrect()
+        assert rf_corr.shape == t_corr.shape == (rfs.ev_num, rfs.rflength)
+        assert not np.isnan(rf_corr).any()